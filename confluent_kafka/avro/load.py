@@ -15,18 +15,31 @@
 # limitations under the License.
 #
 
+import json
 import sys
 
 from confluent_kafka.avro.error import ClientError
 
+# orjson parses schemas considerably faster than the json module avro uses,
+# which matters to clients seeing many schema ids.
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
 
 def loads(schema_str):
     """ Parse a schema given a schema string """
+    try:
+        json_data = _json_loads(schema_str)
+    except ValueError as e:
+        raise ClientError("Schema parse failed: Error parsing schema from JSON: %s" % (str(e)))
+
     try:
         if sys.version_info[0] < 3:
-            return schema.parse(schema_str)
+            return schema.make_avsc_object(json_data, schema.Names())
         else:
-            return schema.Parse(schema_str)
+            return schema.SchemaFromJSONData(json_data, schema.Names())
     except schema.SchemaParseException as e:
         raise ClientError("Schema parse failed: %s" % (str(e)))
 
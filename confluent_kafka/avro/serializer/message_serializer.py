@@ -21,9 +21,8 @@
 #
 import io
 import logging
-import struct
-import sys
-import traceback
+import threading
+from collections import OrderedDict, deque
 
 import avro
 import avro.io
@@ -32,14 +31,23 @@ from confluent_kafka.avro import ClientError
 from confluent_kafka.avro.serializer import (SerializerError,
                                              KeySerializerError,
                                              ValueSerializerError)
+from confluent_kafka.avro.serializer.schema_compiler import (CompiledDatumReader,
+                                                             CompiledDatumWriter,
+                                                             CompiledLazyDatumReader,
+                                                             can_compile)
+from confluent_kafka.avro.serializer.wire import (MAGIC_BYTE,  # noqa
+                                                  MAGIC_PREFIX,
+                                                  BinaryDecoder,
+                                                  BinaryEncoder,
+                                                  pack_header,
+                                                  read_header)
 
 log = logging.getLogger(__name__)
 
-MAGIC_BYTE = 0
 
 HAS_FAST = False
 try:
-    from fastavro import schemaless_reader
+    from fastavro import parse_schema, schemaless_reader
 
     HAS_FAST = True
 except ImportError:
@@ -50,6 +58,7 @@ class ContextStringIO(io.BytesIO):
     """
     Wrapper to allow use of StringIO via 'with' constructs.
     """
+    __slots__ = ()
 
     def __enter__(self):
         return self
@@ -59,6 +68,171 @@ class ContextStringIO(io.BytesIO):
         return False
 
 
+class _Chunks(list):
+    """
+    Write target collecting the written chunks, to be joined into a
+    single bytes object once encoding is done. Joining once is cheaper
+    than growing a BytesIO and copying it out with getvalue().
+    """
+    __slots__ = ()
+
+    write = list.append
+
+
+# Per-thread pool of encoders, each writing to its own _Chunks,
+# reused to avoid allocating both for every produced message.
+_ENCODER_POOL = threading.local()
+
+
+def _acquire_encoder():
+    pool = getattr(_ENCODER_POOL, 'encoders', None)
+    if pool:
+        return pool.pop()
+    return BinaryEncoder(_Chunks())
+
+
+def _release_encoder(encoder):
+    pool = getattr(_ENCODER_POOL, 'encoders', None)
+    if pool is None:
+        pool = _ENCODER_POOL.encoders = deque()
+    del encoder.writer[:]
+    pool.append(encoder)
+
+
+if hasattr(OrderedDict, 'move_to_end'):
+    def _move_to_end(data, key):
+        data.move_to_end(key)
+else:
+    # python 2, not atomic: raises KeyError if another thread removes the
+    # key in between
+    def _move_to_end(data, key):
+        data[key] = data.pop(key)
+
+
+_NO_ENTRY = (object(), None)
+
+
+def _serializer_error(is_key):
+    return KeySerializerError if is_key else ValueSerializerError
+
+
+class LRUCache(object):
+    """
+    Cache holding at most maxsize entries, evicting the least recently
+    used entry when full.
+
+    The most recently used entry is also kept aside, so the common case of
+    many consecutive lookups of the same schema id is a single comparison.
+    It is stored as a single (key, value) tuple, so threads sharing the
+    cache never see the key of one entry with the value of another.
+    """
+    __slots__ = ('maxsize', '_data', '_last')
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._last = _NO_ENTRY
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        last = self._last
+        if key == last[0]:
+            return last[1]
+        data = self._data
+        try:
+            value = data[key]
+        except KeyError:
+            return default
+        try:
+            _move_to_end(data, key)
+        except KeyError:
+            # evicted by another thread in the meantime
+            pass
+        self._last = (key, value)
+        return value
+
+    def put(self, key, value):
+        data = self._data
+        data[key] = value
+        try:
+            _move_to_end(data, key)
+            while len(data) > self.maxsize:
+                data.popitem(last=False)
+        except KeyError:
+            # another thread evicted the key or emptied the cache
+            pass
+        self._last = (key, value) if key in data else _NO_ENTRY
+
+
+def _new_datum_writer(schema_id, schema):
+    if not can_compile(schema):
+        return avro.io.DatumWriter(schema)
+    try:
+        return CompiledDatumWriter(schema, "<schema_%d>" % schema_id)
+    except Exception:
+        log.warning("Unable to compile writer for schema id %d, using avro.io.DatumWriter", schema_id,
+                    exc_info=True)
+        return avro.io.DatumWriter(schema)
+
+
+def _new_datum_reader(schema_id, writer_schema_obj, reader_schema_obj, lazy=False):
+    if reader_schema_obj is None and can_compile(writer_schema_obj):
+        # Without schema resolution the compiled reader for the writer
+        # schema decodes exactly what avro.io.DatumReader would.
+        reader_cls = CompiledLazyDatumReader if lazy else CompiledDatumReader
+        try:
+            return reader_cls(writer_schema_obj, "<schema_%d>" % schema_id)
+        except Exception:
+            log.warning("Unable to compile reader for schema id %d, using avro.io.DatumReader", schema_id,
+                        exc_info=True)
+
+    # Avro DatumReader py2/py3 inconsistency, hence no param keywords
+    # should be revisited later
+    # https://github.com/apache/avro/blob/master/lang/py3/avro/io.py#L459
+    # https://github.com/apache/avro/blob/master/lang/py/src/avro/io.py#L423
+    # def __init__(self, writers_schema=None, readers_schema=None)
+    # def __init__(self, writer_schema=None, reader_schema=None)
+    return avro.io.DatumReader(writer_schema_obj, reader_schema_obj)
+
+
+class PreparedEncoder(object):
+    """
+    Encoder for records of a single registered schema, as returned by
+    MessageSerializer.prepare.
+
+    The writer and the wire format header are resolved once, so encoding
+    skips the cache lookups and header packing done by
+    MessageSerializer.encode_record_with_schema_id.
+    """
+    __slots__ = ('schema', 'schema_id', 'header', '_write')
+
+    def __init__(self, schema, schema_id, write):
+        self.schema = schema
+        self.schema_id = schema_id
+        self.header = pack_header(schema_id)
+        self._write = write
+
+    def encode(self, record):
+        """
+        Encode a record with the prepared schema.
+        @:param record : An object to serialize
+        @:returns : Encoded record with schema ID as bytes
+        """
+        encoder = _acquire_encoder()
+        chunks = encoder.writer
+        try:
+            chunks.append(self.header)
+            self._write(record, encoder)
+            return b''.join(chunks)
+        finally:
+            _release_encoder(encoder)
+
+
 class MessageSerializer(object):
     """
     A helper class that can serialize and deserialize messages
@@ -66,14 +240,32 @@ class MessageSerializer(object):
 
     All encode_* methods return a buffer that can be sent to kafka.
     All decode_* methods expect a buffer received from kafka.
+
+    When lazy is set, records are decoded as read-only LazyRecord mappings
+    which only decode a field once it is accessed. This bypasses fastavro
+    and does not apply when a reader schema is given or the schema
+    uses logical types.
+
+    The writers, decoders and registered schemas are each cached for at
+    most cache_size schemas.
     """
+    __slots__ = ('registry_client', 'id_to_decoder_func', 'id_to_key_decoder_func', 'id_to_writers',
+                 'registered_schemas', 'reader_key_schema', 'reader_value_schema', 'lazy')
 
-    def __init__(self, registry_client, reader_key_schema=None, reader_value_schema=None):
+    def __init__(self, registry_client, reader_key_schema=None, reader_value_schema=None, lazy=False,
+                 cache_size=1024):
         self.registry_client = registry_client
-        self.id_to_decoder_func = {}
-        self.id_to_writers = {}
+        # value and key decoders are cached separately as they may use
+        # different reader schemas
+        self.id_to_decoder_func = LRUCache(cache_size)
+        self.id_to_key_decoder_func = LRUCache(cache_size)
+        self.id_to_writers = LRUCache(cache_size)
+        # (subject, id(schema)) => (schema, schema_id)
+        # The schema is kept alive so its id() can't be reused by another object.
+        self.registered_schemas = LRUCache(cache_size)
         self.reader_key_schema = reader_key_schema
         self.reader_value_schema = reader_value_schema
+        self.lazy = lazy
 
     '''
 
@@ -90,20 +282,45 @@ class MessageSerializer(object):
         @:param is_key : If the record is a key
         @:returns : Encoded record with schema ID as bytes
         """
-        serialize_err = KeySerializerError if is_key else ValueSerializerError
+        schema_id = self._register(schema, is_key)
+
+        # cache writer
+        if schema_id not in self.id_to_writers:
+            self.id_to_writers.put(schema_id, _new_datum_writer(schema_id, schema).write)
 
+        return self.encode_record_with_schema_id(schema_id, record, is_key=is_key)
+
+    def prepare(self, schema, is_key=False):
+        """
+        Register a parsed avro schema and return a PreparedEncoder for it.
+
+        The schema is registered with the subject of 'namespace.name'
+        @:param schema : Avro Schema
+        @:param is_key : If the records are keys
+        @:returns : PreparedEncoder encoding records with the schema ID
+        """
+        schema_id = self._register(schema, is_key)
+        writer = self.id_to_writers.get(schema_id)
+        if writer is None:
+            writer = _new_datum_writer(schema_id, schema).write
+            self.id_to_writers.put(schema_id, writer)
+        return PreparedEncoder(schema, schema_id, writer)
+
+    def _register(self, schema, is_key):
         subject = schema.namespace + '.' + schema.name
 
-        # register it
+        # register it, unless this schema object was already registered
+        cache_key = (subject, id(schema))
+        registered = self.registered_schemas.get(cache_key)
+        if registered is not None:
+            return registered[1]
+
         schema_id = self.registry_client.register(subject, schema)
         if not schema_id:
             message = "Unable to retrieve schema id for subject %s" % (subject)
-            raise serialize_err(message)
-
-        # cache writer
-        self.id_to_writers[schema_id] = avro.io.DatumWriter(schema)
-
-        return self.encode_record_with_schema_id(schema_id, record, is_key=is_key)
+            raise _serializer_error(is_key)(message)
+        self.registered_schemas.put(cache_key, (schema, schema_id))
+        return schema_id
 
     def encode_record_with_schema_id(self, schema_id, record, is_key=False):
         """
@@ -114,46 +331,42 @@ class MessageSerializer(object):
         @:param is_key : If the record is a key
         @:returns: decoder function
         """
-        serialize_err = KeySerializerError if is_key else ValueSerializerError
-
-        # use slow avro
-        if schema_id not in self.id_to_writers:
+        # get the writer
+        writer = self.id_to_writers.get(schema_id)
+        if writer is None:
             # get the writer + schema
 
+            serialize_err = _serializer_error(is_key)
             try:
                 schema = self.registry_client.get_by_id(schema_id)
                 if not schema:
                     raise serialize_err("Schema does not exist")
-                self.id_to_writers[schema_id] = avro.io.DatumWriter(schema)
-            except ClientError:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                raise serialize_err(repr(traceback.format_exception(exc_type, exc_value, exc_traceback)))
-
-        # get the writer
-        writer = self.id_to_writers[schema_id]
-        with ContextStringIO() as outf:
-            # write the header
-            # magic byte
-
-            outf.write(struct.pack('b', MAGIC_BYTE))
-
-            # write the schema ID in network byte order (big end)
-
-            outf.write(struct.pack('>I', schema_id))
+                writer = _new_datum_writer(schema_id, schema).write
+                self.id_to_writers.put(schema_id, writer)
+            except ClientError as e:
+                # raised within the except block, so python 3 chains the
+                # ClientError and keeps its traceback
+                raise serialize_err(str(e))
+
+        encoder = _acquire_encoder()
+        chunks = encoder.writer
+        try:
+            # write the header: magic byte and schema ID
+            chunks.append(pack_header(schema_id))
 
-            # write the record to the rest of it
-            # Create an encoder that we'll write to
-            encoder = avro.io.BinaryEncoder(outf)
-            # write the magic byte
-            # write the object in 'obj' as Avro to the fake file...
-            writer.write(record, encoder)
+            # write the object in 'obj' as Avro after the header
+            writer(record, encoder)
 
-            return outf.getvalue()
+            return b''.join(chunks)
+        finally:
+            _release_encoder(encoder)
 
     # Decoder support
     def _get_decoder_func(self, schema_id, payload, is_key=False):
-        if schema_id in self.id_to_decoder_func:
-            return self.id_to_decoder_func[schema_id]
+        decoders = self.id_to_key_decoder_func if is_key else self.id_to_decoder_func
+        decoder_func = decoders.get(schema_id)
+        if decoder_func is not None:
+            return decoder_func
 
         # fetch writer schema from schema reg
         try:
@@ -164,64 +377,109 @@ class MessageSerializer(object):
         if writer_schema_obj is None:
             raise SerializerError("unable to fetch schema with id %d" % (schema_id))
 
-        curr_pos = payload.tell()
-
         reader_schema_obj = self.reader_key_schema if is_key else self.reader_value_schema
 
-        if HAS_FAST:
+        if HAS_FAST and not self.lazy:
             # try to use fast avro
             try:
-                writer_schema = writer_schema_obj.to_json()
-                reader_schema = reader_schema_obj.to_json()
-                schemaless_reader(payload, writer_schema)
-
-                # If we reach this point, this means we have fastavro and it can
-                # do this deserialization. Rewind since this method just determines
-                # the reader function and we need to deserialize again along the
-                # normal path.
-                payload.seek(curr_pos)
-
-                self.id_to_decoder_func[schema_id] = lambda p: schemaless_reader(
-                    p, writer_schema, reader_schema)
-                return self.id_to_decoder_func[schema_id]
+                # Parse the schemas once per schema id so fastavro does not
+                # have to re-parse them on every message.
+                writer_schema = parse_schema(writer_schema_obj.to_json())
+                if reader_schema_obj is not None:
+                    reader_schema = parse_schema(reader_schema_obj.to_json())
+                else:
+                    reader_schema = None
             except Exception:
-                # Fast avro failed, fall thru to standard avro below.
+                # Fast avro can't handle the schema, use standard avro below.
                 pass
+            else:
+                # bind the reader locally, sparing a global lookup per message
+                read = schemaless_reader
+
+                def fast_decoder(p):
+                    return read(p, writer_schema, reader_schema)
+
+                def first_decoder(p):
+                    # The first message for this schema id decides whether
+                    # fastavro can deserialize it; if it can't, rewind and
+                    # permanently switch to standard avro.
+                    curr_pos = p.tell()
+                    try:
+                        record = fast_decoder(p)
+                    except Exception:
+                        p.seek(curr_pos)
+                        decoder = self._get_slow_decoder_func(schema_id, writer_schema_obj, reader_schema_obj,
+                                                              decoders)
+                        return decoder(p)
+                    decoders.put(schema_id, fast_decoder)
+                    return record
+
+                decoders.put(schema_id, first_decoder)
+                return first_decoder
 
         # here means we should just delegate to slow avro
-        # rewind
-        payload.seek(curr_pos)
-        # Avro DatumReader py2/py3 inconsistency, hence no param keywords
-        # should be revisited later
-        # https://github.com/apache/avro/blob/master/lang/py3/avro/io.py#L459
-        # https://github.com/apache/avro/blob/master/lang/py/src/avro/io.py#L423
-        # def __init__(self, writers_schema=None, readers_schema=None)
-        # def __init__(self, writer_schema=None, reader_schema=None)
-        avro_reader = avro.io.DatumReader(writer_schema_obj, reader_schema_obj)
+        return self._get_slow_decoder_func(schema_id, writer_schema_obj, reader_schema_obj, decoders)
+
+    def _get_slow_decoder_func(self, schema_id, writer_schema_obj, reader_schema_obj, decoders):
+        avro_reader = _new_datum_reader(schema_id, writer_schema_obj, reader_schema_obj, self.lazy)
+        # bind locally, sparing an attribute and a global lookup per message
+        read = avro_reader.read
+        binary_decoder = BinaryDecoder
 
         def decoder(p):
-            bin_decoder = avro.io.BinaryDecoder(p)
-            return avro_reader.read(bin_decoder)
+            return read(binary_decoder(p))
 
-        self.id_to_decoder_func[schema_id] = decoder
-        return self.id_to_decoder_func[schema_id]
+        decoders.put(schema_id, decoder)
+        return decoder
 
     def decode_message(self, message, is_key=False):
         """
         Decode a message from kafka that has been encoded for use with
         the schema registry.
         @:param: message
+        @:param is_key : If the message is a key
+        """
+        if is_key:
+            return self._decode_message(message, self.id_to_key_decoder_func, True)
+        return self._decode_message(message, self.id_to_decoder_func, False)
+
+    def decode_message_key(self, message):
+        """
+        Decode a message key from kafka that has been encoded for use with
+        the schema registry.
+        @:param: message
+        """
+        return self._decode_message(message, self.id_to_key_decoder_func, True)
+
+    def decode_message_value(self, message):
+        """
+        Decode a message value from kafka that has been encoded for use with
+        the schema registry.
+        @:param: message
         """
+        return self._decode_message(message, self.id_to_decoder_func, False)
 
+    def _decode_message(self, message, decoders, is_key):
         if message is None:
             return None
 
-        if len(message) <= 5:
-            raise SerializerError("message is too small to decode")
-
-        with ContextStringIO(message) as payload:
-            magic, schema_id = struct.unpack('>bI', payload.read(5))
-            if magic != MAGIC_BYTE:
-                raise SerializerError("message does not start with magic byte")
+        # a single check guards the common case, the specific error is
+        # only worked out for invalid messages
+        if len(message) <= 5 or message[:1] != MAGIC_PREFIX:
+            if len(message) <= 5:
+                raise SerializerError("message is too small to decode")
+            raise SerializerError("message does not start with magic byte")
+
+        _, schema_id, offset = read_header(message)
+
+        # BytesIO shares the underlying bytes object until written to, so
+        # wrapping the message and seeking past the header does not copy it.
+        payload = io.BytesIO(message)
+        payload.seek(offset)
+        decoder_func = decoders.get(schema_id)
+        if decoder_func is None:
             decoder_func = self._get_decoder_func(schema_id, payload, is_key)
+        try:
             return decoder_func(payload)
+        except EOFError as e:
+            raise SerializerError("message is truncated: %s" % (str(e)))
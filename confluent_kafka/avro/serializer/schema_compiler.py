@@ -0,0 +1,559 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Confluent Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Compiles avro schemas into schema specific reader and writer functions.
+
+avro.io.DatumReader and avro.io.DatumWriter walk the schema for every datum,
+dispatching on the type of every value they read or write. The compiler does
+that walk once per schema and generates straight-line python code which only
+calls the BinaryDecoder/BinaryEncoder primitives, following the same rules
+as the avro implementation.
+"""
+import sys
+from collections import namedtuple
+
+import avro.schema
+from avro.io import AvroTypeException, SchemaResolutionException
+from avro.schema import AvroException
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+if sys.version_info[0] < 3:
+    _STRING_TYPES = (basestring,)  # noqa: F821
+    _BYTES_TYPES = (str,)
+    _INT_TYPES = (int, long)  # noqa: F821
+else:
+    _STRING_TYPES = (str,)
+    _BYTES_TYPES = (bytes,)
+    _INT_TYPES = (int,)
+
+# The generated code follows the rules of avro-python3. The avro package
+# used on python 2 validates records differently and handles logical types.
+_AVRO_PYTHON3 = hasattr(avro.schema, 'SchemaFromJSONData')
+
+INT_MIN_VALUE = -(1 << 31)
+INT_MAX_VALUE = (1 << 31) - 1
+LONG_MIN_VALUE = -(1 << 63)
+LONG_MAX_VALUE = (1 << 63) - 1
+
+_PRIMITIVE_READERS = {
+    'null': 'None',
+    'boolean': 'dec.read_boolean()',
+    'string': 'dec.read_utf8()',
+    'bytes': 'dec.read_bytes()',
+    'int': 'dec.read_int()',
+    'long': 'dec.read_long()',
+    'float': 'dec.read_float()',
+    'double': 'dec.read_double()',
+}
+
+_PRIMITIVE_WRITERS = {
+    'boolean': 'enc.write_boolean(%s)',
+    'string': 'enc.write_utf8(%s)',
+    'bytes': 'enc.write_bytes(%s)',
+    'int': 'enc.write_int(%s)',
+    'long': 'enc.write_long(%s)',
+    'float': 'enc.write_float(%s)',
+    'double': 'enc.write_double(%s)',
+}
+
+_PRIMITIVE_VALIDATORS = {
+    'null': '%(v)s is None',
+    'boolean': 'isinstance(%(v)s, bool)',
+    'string': 'isinstance(%(v)s, _STRING_TYPES)',
+    'bytes': 'isinstance(%(v)s, _BYTES_TYPES)',
+    'int': 'isinstance(%(v)s, _INT_TYPES) and INT_MIN_VALUE <= %(v)s <= INT_MAX_VALUE',
+    'long': 'isinstance(%(v)s, _INT_TYPES) and LONG_MIN_VALUE <= %(v)s <= LONG_MAX_VALUE',
+    'float': 'isinstance(%(v)s, _NUMBER_TYPES)',
+    'double': 'isinstance(%(v)s, _NUMBER_TYPES)',
+}
+
+_PRIMITIVE_SKIPPERS = {
+    'null': [],
+    'boolean': ['dec.skip(1)'],
+    'string': ['dec.skip(dec.read_long())'],
+    'bytes': ['dec.skip(dec.read_long())'],
+    'int': ['dec.skip_long()'],
+    'long': ['dec.skip_long()'],
+    'float': ['dec.skip(4)'],
+    'double': ['dec.skip(8)'],
+    'enum': ['dec.skip_long()'],
+}
+
+_RECORD_TYPES = ('record', 'error', 'request')
+_UNION_TYPES = ('union', 'error_union')
+
+
+class _SchemaCompiler(object):
+    """
+    Generates the source of the reader, writer and validator functions for a
+    schema. Every complex schema gets its own function, named types are
+    generated only once so recursive schemas turn into recursive calls.
+    """
+
+    def __init__(self):
+        self.namespace = {
+            'AvroTypeException': AvroTypeException,
+            'SchemaResolutionException': SchemaResolutionException,
+            '_STRING_TYPES': _STRING_TYPES,
+            '_BYTES_TYPES': _BYTES_TYPES,
+            '_INT_TYPES': _INT_TYPES,
+            '_NUMBER_TYPES': _INT_TYPES + (float,),
+            'INT_MIN_VALUE': INT_MIN_VALUE,
+            'INT_MAX_VALUE': INT_MAX_VALUE,
+            'LONG_MIN_VALUE': LONG_MIN_VALUE,
+            'LONG_MAX_VALUE': LONG_MAX_VALUE,
+        }
+        self.functions = {}
+        self.lines = []
+
+    def constant(self, value):
+        name = '_const_%d' % len(self.namespace)
+        self.namespace[name] = value
+        return name
+
+    def function(self, kind, schema, args, build):
+        """
+        Returns the name of the `kind` function for schema, generating it
+        with build(schema) on first use.
+        """
+        key = (kind, id(schema))
+        if key in self.functions:
+            return self.functions[key]
+
+        # Register the name before building the body so that named types
+        # referencing themselves compile into a recursive call.
+        name = '%s_%d' % (kind, len(self.functions))
+        self.functions[key] = name
+
+        body = build(schema) or ['pass']
+        self.lines.append('def %s(%s):' % (name, args))
+        self.lines.extend('    ' + line for line in body)
+        self.lines.append('')
+        return name
+
+    def compile(self, filename):
+        code = compile('\n'.join(self.lines), filename, 'exec')
+        exec(code, self.namespace)
+        return self.namespace
+
+    # Readers
+    def reader(self, schema):
+        """Returns an expression reading schema from decoder `dec`"""
+        t = schema.type
+        if t in _PRIMITIVE_READERS:
+            return _PRIMITIVE_READERS[t]
+        if t == 'fixed':
+            return 'dec.read(%d)' % schema.size
+        builders = {'enum': self._enum_reader,
+                    'array': self._array_reader,
+                    'map': self._map_reader}
+        for k in _UNION_TYPES:
+            builders[k] = self._union_reader
+        for k in _RECORD_TYPES:
+            builders[k] = self._record_reader
+        if t not in builders:
+            raise AvroException("Cannot read unknown schema type: %s" % t)
+        return '%s(dec)' % self.function('read', schema, 'dec', builders[t])
+
+    def _enum_reader(self, schema):
+        symbols = self.constant(list(schema.symbols))
+        s = self.constant(schema)
+        return ['index = dec.read_int()',
+                'if index >= %d:' % len(schema.symbols),
+                '    raise SchemaResolutionException("Can\'t access enum index %%d for enum with %d symbols"'
+                ' %% index, %s, %s)' % (len(schema.symbols), s, s),
+                'return %s[index]' % symbols]
+
+    def _array_reader(self, schema):
+        return ['items = []',
+                'append = items.append',
+                'block_count = dec.read_long()',
+                'while block_count != 0:',
+                '    if block_count < 0:',
+                '        block_count = -block_count',
+                '        dec.read_long()',
+                '    for _ in range(block_count):',
+                '        append(%s)' % self.reader(schema.items),
+                '    block_count = dec.read_long()',
+                'return items']
+
+    def _map_reader(self, schema):
+        return ['items = {}',
+                'block_count = dec.read_long()',
+                'while block_count != 0:',
+                '    if block_count < 0:',
+                '        block_count = -block_count',
+                '        dec.read_long()',
+                '    for _ in range(block_count):',
+                '        key = dec.read_utf8()',
+                '        items[key] = %s' % self.reader(schema.values),
+                '    block_count = dec.read_long()',
+                'return items']
+
+    def _union_reader(self, schema):
+        s = self.constant(schema)
+        lines = ['index = dec.read_long()']
+        for i, branch in enumerate(schema.schemas):
+            lines.append('if index == %d:' % i)
+            lines.append('    return %s' % self.reader(branch))
+        lines.append('raise SchemaResolutionException("Can\'t access branch index %%d for union with %d branches"'
+                     ' %% index, %s, %s)' % (len(schema.schemas), s, s))
+        return lines
+
+    def _record_reader(self, schema):
+        # dict displays are evaluated in order, matching the field order
+        # of the encoded record
+        fields = ['%r: %s' % (f.name, self.reader(f.type)) for f in schema.fields]
+        return ['return {%s}' % ', '.join(fields)]
+
+    # Skippers
+    def skipper(self, schema):
+        """Returns the statements skipping over schema in decoder `dec`"""
+        t = schema.type
+        if t in _PRIMITIVE_SKIPPERS:
+            return _PRIMITIVE_SKIPPERS[t]
+        if t == 'fixed':
+            return ['dec.skip(%d)' % schema.size]
+        builders = {'array': self._array_skipper,
+                    'map': self._map_skipper}
+        for k in _UNION_TYPES:
+            builders[k] = self._union_skipper
+        for k in _RECORD_TYPES:
+            builders[k] = self._record_skipper
+        if t not in builders:
+            raise AvroException("Unknown schema type: %s" % t)
+        return ['%s(dec)' % self.function('skip', schema, 'dec', builders[t])]
+
+    def _array_skipper(self, schema):
+        return ['block_count = dec.read_long()',
+                'while block_count != 0:',
+                '    if block_count < 0:',
+                '        dec.skip(dec.read_long())',
+                '    else:',
+                '        for _ in range(block_count):'] + \
+               ['            ' + line for line in self.skipper(schema.items) or ['pass']] + \
+               ['    block_count = dec.read_long()']
+
+    def _map_skipper(self, schema):
+        return ['block_count = dec.read_long()',
+                'while block_count != 0:',
+                '    if block_count < 0:',
+                '        dec.skip(dec.read_long())',
+                '    else:',
+                '        for _ in range(block_count):',
+                '            dec.skip(dec.read_long())'] + \
+               ['            ' + line for line in self.skipper(schema.values)] + \
+               ['    block_count = dec.read_long()']
+
+    def _union_skipper(self, schema):
+        s = self.constant(schema)
+        lines = ['index = dec.read_long()']
+        for i, branch in enumerate(schema.schemas):
+            lines.append('%s index == %d:' % ('elif' if i else 'if', i))
+            lines.extend('    ' + line for line in self.skipper(branch) or ['pass'])
+        lines.append('else:')
+        lines.append('    raise SchemaResolutionException("Can\'t access branch index %%d for union with %d branches"'
+                     ' %% index, %s, %s)' % (len(schema.schemas), s, s))
+        return lines
+
+    def _record_skipper(self, schema):
+        lines = []
+        for f in schema.fields:
+            lines.extend(self.skipper(f.type))
+        return lines
+
+    # Writers
+    def writer(self, schema, var):
+        """Returns the statements writing `var` as schema to encoder `enc`"""
+        t = schema.type
+        if t == 'null':
+            return []
+        if t in _PRIMITIVE_WRITERS:
+            return [_PRIMITIVE_WRITERS[t] % var]
+        if t == 'fixed':
+            return ['enc.write(%s)' % var]
+        builders = {'enum': self._enum_writer,
+                    'array': self._array_writer,
+                    'map': self._map_writer}
+        for k in _UNION_TYPES:
+            builders[k] = self._union_writer
+        for k in _RECORD_TYPES:
+            builders[k] = self._record_writer
+        if t not in builders:
+            raise AvroException("Unknown type: %s" % t)
+        return ['%s(enc, %s)' % (self.function('write', schema, 'enc, v', builders[t]), var)]
+
+    def _enum_writer(self, schema):
+        return ['enc.write_int(%s.index(v))' % self.constant(list(schema.symbols))]
+
+    def _array_writer(self, schema):
+        return ['if len(v) > 0:',
+                '    enc.write_long(len(v))',
+                '    for item in v:'] + \
+               ['        ' + line for line in self.writer(schema.items, 'item') or ['pass']] + \
+               ['enc.write_long(0)']
+
+    def _map_writer(self, schema):
+        return ['if len(v) > 0:',
+                '    enc.write_long(len(v))',
+                '    for key, item in v.items():',
+                '        enc.write_utf8(key)'] + \
+               ['        ' + line for line in self.writer(schema.values, 'item')] + \
+               ['enc.write_long(0)']
+
+    def _union_writer(self, schema):
+        # avro.io.DatumWriter writes the last branch the datum validates
+        # against, so test the branches in reverse order.
+        lines = []
+        for i, branch in reversed(list(enumerate(schema.schemas))):
+            lines.append('%s %s:' % ('elif' if lines else 'if', self.validator(branch, 'v')))
+            lines.append('    enc.write_long(%d)' % i)
+            lines.extend('    ' + line for line in self.writer(branch, 'v'))
+        lines.append('else:')
+        lines.append('    raise AvroTypeException(%s, v)' % self.constant(schema))
+        return lines
+
+    def _record_writer(self, schema):
+        lines = []
+        for f in schema.fields:
+            lines.extend(self.writer(f.type, 'v.get(%r)' % f.name))
+        return lines
+
+    # Validators
+    def validator(self, schema, var):
+        """Returns an expression testing whether `var` is valid for schema"""
+        t = schema.type
+        if t in _PRIMITIVE_VALIDATORS:
+            return _PRIMITIVE_VALIDATORS[t] % {'v': var}
+        builders = {'fixed': self._fixed_validator,
+                    'enum': self._enum_validator,
+                    'array': self._array_validator,
+                    'map': self._map_validator}
+        for k in _UNION_TYPES:
+            builders[k] = self._union_validator
+        for k in _RECORD_TYPES:
+            builders[k] = self._record_validator
+        if t not in builders:
+            raise AvroException("Unknown type: %s" % t)
+        return '%s(%s)' % (self.function('valid', schema, 'v', builders[t]), var)
+
+    def _fixed_validator(self, schema):
+        return ['return isinstance(v, _BYTES_TYPES) and len(v) == %d' % schema.size]
+
+    def _enum_validator(self, schema):
+        return ['return v in %s' % self.constant(list(schema.symbols))]
+
+    def _array_validator(self, schema):
+        return ['return isinstance(v, list) and all(%s for item in v)' % self.validator(schema.items, 'item')]
+
+    def _map_validator(self, schema):
+        return ['return (isinstance(v, dict) and all(isinstance(key, _STRING_TYPES) for key in v)',
+                '        and all(%s for item in v.values()))' % self.validator(schema.values, 'item')]
+
+    def _union_validator(self, schema):
+        return ['return (%s)' % ' or '.join('(%s)' % self.validator(b, 'v') for b in schema.schemas)]
+
+    def _record_validator(self, schema):
+        lines = ['if not isinstance(v, dict):',
+                 '    return False']
+        for f in schema.fields:
+            lines.append('item = v.get(%r)' % f.name)
+            lines.append('if not (%s):' % self.validator(f.type, 'item'))
+            lines.append('    return False')
+        field_names = self.constant(frozenset(f.name for f in schema.fields))
+        lines.append('return %s.issuperset(v)' % field_names)
+        return lines
+
+
+def can_compile(schema):
+    """
+    Whether the compiled reader and writer for the given parsed avro schema
+    behave exactly like avro.io.DatumReader and avro.io.DatumWriter.
+
+    Logical types are not supported by the compiler.
+    @:param schema : Avro Schema
+    @:returns : True if the schema can be compiled
+    """
+    return _AVRO_PYTHON3 and 'logicalType' not in str(schema)
+
+
+def compile_reader(schema, filename='<schema>'):
+    """
+    Compile a function reading a datum of the given parsed avro schema.
+
+    @:param schema : Avro Schema
+    @:param filename : Name the generated code is attributed to in tracebacks
+    @:returns : read(decoder) function returning the decoded datum
+    """
+    compiler = _SchemaCompiler()
+    compiler.lines.extend(['def read(dec):',
+                           '    return %s' % compiler.reader(schema),
+                           ''])
+    return compiler.compile(filename)['read']
+
+
+def compile_field_readers(schema, filename='<schema>'):
+    """
+    Compile functions reading and skipping each field of a record schema.
+
+    @:param schema : Avro record schema
+    @:param filename : Name the generated code is attributed to in tracebacks
+    @:returns : (list of read(decoder) functions, list of skip(decoder) functions)
+                in field order
+    """
+    compiler = _SchemaCompiler()
+    for i, f in enumerate(schema.fields):
+        # generate the bodies first, they may add functions of their own
+        read = compiler.reader(f.type)
+        skip = compiler.skipper(f.type) or ['pass']
+        compiler.lines.extend(['def read_field_%d(dec):' % i,
+                               '    return %s' % read,
+                               '',
+                               'def skip_field_%d(dec):' % i])
+        compiler.lines.extend('    ' + line for line in skip)
+        compiler.lines.append('')
+    namespace = compiler.compile(filename)
+    count = len(schema.fields)
+    return ([namespace['read_field_%d' % i] for i in range(count)],
+            [namespace['skip_field_%d' % i] for i in range(count)])
+
+
+def compile_writer(schema, filename='<schema>'):
+    """
+    Compile a function validating and writing a datum of the given parsed
+    avro schema.
+
+    @:param schema : Avro Schema
+    @:param filename : Name the generated code is attributed to in tracebacks
+    @:returns : write(datum, encoder) function
+    """
+    compiler = _SchemaCompiler()
+    valid = compiler.validator(schema, 'datum')
+    body = compiler.writer(schema, 'datum')
+    compiler.lines.extend(['def write(datum, enc):',
+                           '    if not (%s):' % valid,
+                           '        raise AvroTypeException(%s, datum)' % compiler.constant(schema)])
+    compiler.lines.extend('    ' + line for line in body)
+    compiler.lines.append('')
+    return compiler.compile(filename)['write']
+
+
+class CompiledDatumReader(object):
+    """
+    Schema specific replacement for avro.io.DatumReader reading
+    datums written with, and read as, the given schema.
+    """
+
+    def __init__(self, writer_schema, filename='<schema>'):
+        self.writer_schema = writer_schema
+        self.read = compile_reader(writer_schema, filename)
+
+
+_RecordLayout = namedtuple('_RecordLayout', ['names', 'index', 'readers', 'skippers'])
+
+
+class LazyRecord(Mapping):
+    """
+    Read-only mapping of a record's field names to values, decoding each
+    field the first time it is accessed.
+
+    The offset of every field is found by skipping over the fields preceding
+    it, starting from the last offset already known, so accessing a few
+    fields of a wide record only decodes those fields.
+    """
+    __slots__ = ('_decoder', '_layout', '_offsets', '_values')
+
+    def __init__(self, decoder, layout):
+        self._decoder = decoder
+        self._layout = layout
+        self._offsets = [decoder.reader.tell()]
+        self._values = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+
+        layout = self._layout
+        index = layout.index[key]
+        decoder = self._decoder
+        reader = decoder.reader
+        offsets = self._offsets
+
+        if index >= len(offsets):
+            reader.seek(offsets[-1])
+            for skip in layout.skippers[len(offsets) - 1:index]:
+                skip(decoder)
+                offsets.append(reader.tell())
+
+        reader.seek(offsets[index])
+        value = layout.readers[index](decoder)
+        if index + 1 == len(offsets):
+            offsets.append(reader.tell())
+
+        self._values[key] = value
+        return value
+
+    def __contains__(self, key):
+        return key in self._layout.index
+
+    def __iter__(self):
+        return iter(self._layout.names)
+
+    def __len__(self):
+        return len(self._layout.names)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self))
+
+
+class CompiledLazyDatumReader(object):
+    """
+    Schema specific reader returning records as LazyRecord instances.
+
+    Datums of non-record schemas are read eagerly.
+    """
+
+    def __init__(self, writer_schema, filename='<schema>'):
+        self.writer_schema = writer_schema
+        if writer_schema.type not in _RECORD_TYPES:
+            self.read = compile_reader(writer_schema, filename)
+            return
+
+        readers, skippers = compile_field_readers(writer_schema, filename)
+        names = [f.name for f in writer_schema.fields]
+        self._layout = _RecordLayout(names, dict((name, i) for i, name in enumerate(names)),
+                                     readers, skippers)
+
+    def read(self, decoder):
+        return LazyRecord(decoder, self._layout)
+
+
+class CompiledDatumWriter(object):
+    """
+    Schema specific replacement for avro.io.DatumWriter.
+    """
+
+    def __init__(self, writer_schema, filename='<schema>'):
+        self.writer_schema = writer_schema
+        self.write = compile_writer(writer_schema, filename)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Confluent Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Confluent wire format header and avro binary encoding primitives.
+
+The BinaryEncoder and BinaryDecoder classes are drop-in replacements for the
+avro.io classes of the same name. avro.io writes and reads variable-length
+integers one byte at a time through several method calls per byte; these
+implementations do the zig-zag and varint coding inline and issue a single
+write per value.
+"""
+import struct
+
+import avro.io
+
+MAGIC_BYTE = 0
+MAGIC_PREFIX = struct.pack('b', MAGIC_BYTE)
+
+# Confluent wire format header: magic byte followed by the schema id in
+# network byte order (big end)
+HEADER_STRUCT = struct.Struct('>bI')
+
+_FLOAT_STRUCT = struct.Struct('<f')
+_DOUBLE_STRUCT = struct.Struct('<d')
+
+# Single byte encodings of the zig-zag encoded values -64..63
+_SMALL_LONGS = dict((n, struct.pack('B', (n << 1) ^ (n >> 63))) for n in range(-64, 64))
+
+# Values of the single byte encodings, the inverse of _SMALL_LONGS
+_SMALL_LONG_VALUES = dict((v, k) for k, v in _SMALL_LONGS.items())
+
+
+def _truncated():
+    return EOFError("unexpected end of avro data")
+
+
+def pack_header(schema_id):
+    """
+    Pack the wire format header for schema_id.
+    @:param schema_id : integer ID
+    @:returns : header as bytes
+    """
+    return HEADER_STRUCT.pack(MAGIC_BYTE, schema_id)
+
+
+def read_header(message):
+    """
+    Unpack the wire format header at the start of message.
+    @:param message : buffer received from kafka
+    @:returns : (magic byte, schema id, offset of the avro payload)
+    """
+    magic, schema_id = HEADER_STRUCT.unpack_from(message, 0)
+    return magic, schema_id, HEADER_STRUCT.size
+
+
+class BinaryEncoder(avro.io.BinaryEncoder):
+    """
+    avro.io.BinaryEncoder writing every value with a single write call.
+    """
+
+    def __init__(self, writer):
+        super(BinaryEncoder, self).__init__(writer)
+        self._write = writer.write
+
+    def write_boolean(self, datum):
+        self._write(b'\x01' if datum else b'\x00')
+
+    def write_long(self, datum):
+        encoded = _SMALL_LONGS.get(datum)
+        if encoded is not None:
+            self._write(encoded)
+            return
+
+        datum = (datum << 1) ^ (datum >> 63)
+        encoded = bytearray()
+        while datum & ~0x7F:
+            encoded.append((datum & 0x7F) | 0x80)
+            datum >>= 7
+        encoded.append(datum)
+        # bytes, not the bytearray: python 2's str.join rejects bytearrays
+        self._write(bytes(encoded))
+
+    write_int = write_long
+
+    def write_float(self, datum):
+        self._write(_FLOAT_STRUCT.pack(datum))
+
+    def write_double(self, datum):
+        self._write(_DOUBLE_STRUCT.pack(datum))
+
+    def write_bytes(self, datum):
+        self.write_long(len(datum))
+        self._write(datum)
+
+    def write_utf8(self, datum):
+        self.write_bytes(datum.encode('utf-8'))
+
+
+class BinaryDecoder(avro.io.BinaryDecoder):
+    """
+    avro.io.BinaryDecoder decoding varints without a method call per byte.
+    """
+
+    def __init__(self, reader):
+        super(BinaryDecoder, self).__init__(reader)
+        self._read = reader.read
+
+    def read(self, n):
+        data = self._read(n)
+        if len(data) != n:
+            raise _truncated()
+        return data
+
+    def read_boolean(self):
+        c = self._read(1)
+        if not c:
+            raise _truncated()
+        return c == b'\x01'
+
+    def read_long(self):
+        read = self._read
+        c = read(1)
+        # most ints and longs on the wire (lengths, counts, union and enum
+        # indexes) fit in a single byte; look those up instead of decoding
+        if c < b'\x80':
+            if not c:
+                raise _truncated()
+            return _SMALL_LONG_VALUES[c]
+
+        n = ord(c) & 0x7F
+        shift = 7
+        b = 0x80
+        while b & 0x80:
+            c = read(1)
+            if not c:
+                raise _truncated()
+            b = ord(c)
+            n |= (b & 0x7F) << shift
+            shift += 7
+        return (n >> 1) ^ -(n & 1)
+
+    read_int = read_long
+
+    def skip_long(self):
+        read = self._read
+        c = read(1)
+        while c >= b'\x80':
+            c = read(1)
+        if not c:
+            raise _truncated()
+
+    skip_int = skip_long
+
+    def read_float(self):
+        return _FLOAT_STRUCT.unpack(self.read(4))[0]
+
+    def read_double(self):
+        return _DOUBLE_STRUCT.unpack(self.read(8))[0]
+
+    def read_bytes(self):
+        return self.read(self.read_long())
+
+    def read_utf8(self):
+        return self.read_bytes().decode('utf-8')
@@ -21,11 +21,19 @@
 #
 
 import struct
+import threading
+import time
 
 import unittest
 
+from avro import io as avro_io
+from avro.io import AvroTypeException
+
 from tests.avro import data_gen
-from confluent_kafka.avro.serializer.message_serializer import MessageSerializer
+from confluent_kafka.avro import ClientError
+from confluent_kafka.avro.serializer import message_serializer, schema_compiler, SerializerError, ValueSerializerError
+from confluent_kafka.avro.serializer.schema_compiler import CompiledDatumWriter
+from confluent_kafka.avro.serializer.message_serializer import LRUCache, MessageSerializer
 from tests.avro.mock_schema_registry_client import MockSchemaRegistryClient
 from confluent_kafka import avro
 
@@ -74,10 +82,250 @@ class TestMessageSerializer(unittest.TestCase):
             message = self.ms.encode_record_with_schema(basic, record)
             self.assertMessageIsSame(message, record, schema_id)
 
+    def test_encode_reuses_buffers(self):
+        """"Pooled encode buffers should not leak data between records"""
+
+        basic = avro.loads(data_gen.BASIC_SCHEMA)
+        schema_id = self.client.register('test', basic)
+        records = [{'name': 'x' * 1000, 'number': 1},
+                   {'name': 'y', 'number': None},
+                   {'name': 'z' * 10, 'number': 2}]
+        for record in records:
+            message = self.ms.encode_record_with_schema_id(schema_id, record)
+            self.assertMessageIsSame(message, record, schema_id)
+
+    def test_encode_multi_byte_varints(self):
+        basic = avro.loads(data_gen.BASIC_SCHEMA)
+        schema_id = self.client.register('test', basic)
+        for record in ({'name': 'x' * 64, 'number': 64},
+                       {'name': 'y' * 100000, 'number': -(1 << 31)}):
+            message = self.ms.encode_record_with_schema_id(schema_id, record)
+            self.assertMessageIsSame(message, record, schema_id)
+
+    def test_encode_record_with_schema_registers_once(self):
+        basic = avro.loads(data_gen.BASIC_SCHEMA)
+        calls = []
+        register = self.client.register
+
+        def counting_register(subject, schema):
+            calls.append(subject)
+            return register(subject, schema)
+
+        self.client.register = counting_register
+        record = {'name': 'stefan', 'number': 1}
+        for _ in range(3):
+            message = self.ms.encode_record_with_schema(basic, record)
+            self.assertMessageIsSame(message, record, 1)
+        self.assertEqual(len(calls), 1)
+
+    def test_prepare(self):
+        basic = avro.loads(data_gen.BASIC_SCHEMA)
+        prepared = self.ms.prepare(basic)
+        schema_id = self.client.register('python.test.basic.basic', basic)
+        self.assertEqual(prepared.schema_id, schema_id)
+        for record in data_gen.BASIC_ITEMS:
+            message = prepared.encode(record)
+            self.assertEqual(message, self.ms.encode_record_with_schema(basic, record))
+            self.assertMessageIsSame(message, record, schema_id)
+
+        with self.assertRaises(AvroTypeException):
+            prepared.encode({'name': 1})
+
+    def test_encode_registry_error(self):
+        def failing_get_by_id(schema_id):
+            raise ClientError("registry unavailable")
+
+        self.client.get_by_id = failing_get_by_id
+        with self.assertRaises(ValueSerializerError) as ctx:
+            self.ms.encode_record_with_schema_id(1, {'name': 'x'})
+        self.assertEqual(ctx.exception.message, "registry unavailable")
+
+    def test_decode_lazy(self):
+        ms = MessageSerializer(self.client, lazy=True)
+        adv = avro.loads(data_gen.ADVANCED_SCHEMA)
+        schema_id = self.client.register('test_adv', adv)
+        for record in map(data_gen.create_adv_item, range(1, 5)):
+            message = ms.encode_record_with_schema_id(schema_id, record)
+            decoded = ms.decode_message(message)
+            self.assertEqual(decoded['friends'], record['friends'])
+            self.assertEqual(decoded, record)
+
+    def test_small_cache(self):
+        ms = MessageSerializer(self.client, cache_size=1)
+        basic = avro.loads(data_gen.BASIC_SCHEMA)
+        adv = avro.loads(data_gen.ADVANCED_SCHEMA)
+        basic_record = data_gen.create_basic_item(1)
+        adv_record = data_gen.create_adv_item(1)
+        for _ in range(2):
+            for schema, record in ((basic, basic_record), (adv, adv_record)):
+                message = ms.encode_record_with_schema(schema, record)
+                self.assertEqual(ms.decode_message(message), record)
+                self.assertEqual(len(ms.id_to_writers), 1)
+                self.assertEqual(len(ms.id_to_decoder_func), 1)
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.put(1, 'a')
+        cache.put(2, 'b')
+        self.assertEqual(cache.get(1), 'a')
+        cache.put(3, 'c')
+        self.assertNotIn(2, cache)
+        self.assertEqual(cache.get(1), 'a')
+        self.assertEqual(cache.get(3), 'c')
+        self.assertIsNone(cache.get(2))
+        cache.put(3, 'd')
+        self.assertEqual(cache.get(3), 'd')
+        self.assertEqual(len(cache), 2)
+
+    def test_lru_cache_threads(self):
+        """"Threads sharing a cache should only get the values of their own keys"""
+
+        class YieldingKey(object):
+            # gives other threads a chance to run in the middle of a lookup
+            def __init__(self, n):
+                self.n = n
+
+            def __hash__(self):
+                return self.n
+
+            def __eq__(self, other):
+                time.sleep(0)
+                return isinstance(other, YieldingKey) and other.n == self.n
+
+        cache = LRUCache()
+        keys = [YieldingKey(n) for n in range(4)]
+        for key in keys:
+            cache.put(key, key.n)
+        errors = []
+
+        def lookup(key):
+            for _ in range(1000):
+                value = cache.get(key)
+                if value != key.n:
+                    errors.append((key.n, value))
+                    return
+
+        threads = [threading.Thread(target=lookup, args=(key,)) for key in keys]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+    def test_lru_cache_concurrent_eviction(self):
+        """"Keys evicted by another thread while being moved should not fail lookups"""
+
+        def evicting_move_to_end(data, key):
+            del data[key]
+            raise KeyError(key)
+
+        cache = LRUCache(2)
+        cache.put(1, 'a')
+        cache.put(2, 'b')
+        orig = message_serializer._move_to_end
+        message_serializer._move_to_end = evicting_move_to_end
+        try:
+            self.assertEqual(cache.get(1), 'a')
+            cache.put(3, 'c')
+        finally:
+            message_serializer._move_to_end = orig
+        self.assertNotIn(1, cache)
+        self.assertNotIn(3, cache)
+        self.assertEqual(cache.get(2), 'b')
+
+    def test_decode_key_and_value_reader_schemas(self):
+        writer = avro.load(data_gen.get_schema_path('user_v2.avsc'))
+        reader = avro.loads('{"type": "record", "name": "User", "fields": [{"name": "name", "type": "string"}]}')
+        schema_id = self.client.register('test', writer)
+        ms = MessageSerializer(self.client, reader_key_schema=reader)
+        record = {'name': 'stefan', 'favorite_number': 7, 'favorite_color': None}
+        message = ms.encode_record_with_schema_id(schema_id, record)
+        for _ in range(2):
+            self.assertEqual(ms.decode_message_key(message), {'name': 'stefan'})
+            self.assertEqual(ms.decode_message_value(message), record)
+            self.assertEqual(ms.decode_message(message, is_key=True), {'name': 'stefan'})
+            self.assertEqual(ms.decode_message(message), record)
+
+    def test_encode_invalid_record(self):
+        basic = avro.loads(data_gen.BASIC_SCHEMA)
+        schema_id = self.client.register('test', basic)
+        with self.assertRaises(AvroTypeException):
+            self.ms.encode_record_with_schema_id(schema_id, {'name': 1, 'number': 1})
+
+        # the encoder buffer is reused after a failure
+        record = {'name': 'stefan', 'number': 1}
+        message = self.ms.encode_record_with_schema_id(schema_id, record)
+        self.assertMessageIsSame(message, record, schema_id)
+
     def test_decode_none(self):
         """"null/None messages should decode to None"""
 
         self.assertIsNone(self.ms.decode_message(None))
 
+    def test_decode_falls_back_to_slow_avro(self):
+        """"Schemas fastavro fails to decode should be decoded by avro"""
+
+        basic = avro.loads(data_gen.BASIC_SCHEMA)
+        schema_id = self.client.register('test', basic)
+        record = {'name': 'stefan', 'number': 1}
+        message = self.ms.encode_record_with_schema_id(schema_id, record)
+
+        def failing_reader(*args, **kwargs):
+            raise ValueError("unsupported")
+
+        orig_reader = getattr(message_serializer, 'schemaless_reader', None)
+        message_serializer.schemaless_reader = failing_reader
+        try:
+            self.assertMessageIsSame(message, record, schema_id)
+            self.assertMessageIsSame(message, record, schema_id)
+        finally:
+            message_serializer.schemaless_reader = orig_reader
+
+    def test_logical_types_use_avro(self):
+        """"Schemas with logical types should not use the compiled writer and reader"""
+
+        schema = avro.loads('{"type": "record", "name": "Event", "fields": ['
+                            '{"name": "day", "type": {"type": "int", "logicalType": "date"}}]}')
+        schema_id = self.client.register('test', schema)
+        self.assertIs(type(message_serializer._new_datum_writer(schema_id, schema)), avro_io.DatumWriter)
+        self.assertIs(type(message_serializer._new_datum_reader(schema_id, schema, None)), avro_io.DatumReader)
+
+        ms = MessageSerializer(self.client)
+        ms.prepare(schema)
+        self.assertNotIsInstance(ms.id_to_writers.get(schema_id).__self__, CompiledDatumWriter)
+
+    def test_non_avro_python3_uses_avro(self):
+        """"Other avro implementations should not use the compiled writer and reader"""
+
+        basic = avro.loads(data_gen.BASIC_SCHEMA)
+        orig = schema_compiler._AVRO_PYTHON3
+        schema_compiler._AVRO_PYTHON3 = False
+        try:
+            self.assertIs(type(message_serializer._new_datum_writer(1, basic)), avro_io.DatumWriter)
+            self.assertIs(type(message_serializer._new_datum_reader(1, basic, None)), avro_io.DatumReader)
+            schema_id = self.client.register('test', basic)
+            for record in data_gen.BASIC_ITEMS:
+                message = self.ms.encode_record_with_schema_id(schema_id, record)
+                self.assertMessageIsSame(message, record, schema_id)
+        finally:
+            schema_compiler._AVRO_PYTHON3 = orig
+
+    def test_decode_invalid_header(self):
+        for message in (b'', b'\x00\x00\x00\x00\x01', b'\x01\x00\x00\x00\x01\x02'):
+            with self.assertRaises(SerializerError):
+                self.ms.decode_message(message)
+
+        # truncated payload, on the fastavro and the avro decoding paths
+        basic = avro.loads(data_gen.BASIC_SCHEMA)
+        schema_id = self.client.register('test', basic)
+        message = self.ms.encode_record_with_schema_id(schema_id, {'name': 'x' * 100, 'number': 1 << 20})
+        lazy_ms = MessageSerializer(self.client, lazy=True)
+        for size in (6, 7, 50, len(message) - 2):
+            with self.assertRaises(SerializerError):
+                self.ms.decode_message(message[:size])
+            # lazy records only decode, and find the end of data, on access
+            with self.assertRaises(EOFError):
+                dict(lazy_ms.decode_message(message[:size]))
+
     def hash_func(self):
         return hash(str(self))
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Confluent Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import io
+import unittest
+
+import avro.io
+
+from tests.avro import data_gen
+from confluent_kafka import avro as confluent_avro
+from confluent_kafka.avro.serializer.schema_compiler import (CompiledDatumReader,
+                                                             CompiledDatumWriter,
+                                                             CompiledLazyDatumReader)
+
+RECURSIVE_SCHEMA = """
+{
+  "type": "record",
+  "name": "Node",
+  "fields": [
+    {"name": "label", "type": "string"},
+    {"name": "children", "type": {"type": "array", "items": "Node"}},
+    {"name": "next", "type": ["null", "Node"]}
+  ]
+}
+"""
+
+ALL_TYPES_SCHEMA = """
+{
+  "type": "record",
+  "name": "AllTypes",
+  "fields": [
+    {"name": "b", "type": "boolean"},
+    {"name": "i", "type": "int"},
+    {"name": "l", "type": "long"},
+    {"name": "f", "type": "float"},
+    {"name": "d", "type": "double"},
+    {"name": "raw", "type": "bytes"},
+    {"name": "s", "type": "string"},
+    {"name": "n", "type": "null"},
+    {"name": "fx", "type": {"type": "fixed", "name": "Four", "size": 4}},
+    {"name": "e", "type": {"type": "enum", "name": "Suit", "symbols": ["SPADES", "HEARTS"]}},
+    {"name": "m", "type": {"type": "map", "values": ["null", "long"]}},
+    {"name": "a", "type": {"type": "array", "items": "Suit"}},
+    {"name": "u", "type": ["int", "long", "string"]}
+  ]
+}
+"""
+
+ALL_TYPES_ITEM = {
+    'b': True,
+    'i': -42,
+    'l': 1 << 40,
+    'f': 1.5,
+    'd': -2.25,
+    'raw': b'\x00\x01',
+    's': u'\xe9t\xe9',
+    'n': None,
+    'fx': b'abcd',
+    'e': 'HEARTS',
+    'm': {'one': 1, 'none': None},
+    'a': ['SPADES', 'HEARTS', 'SPADES'],
+    'u': 7,
+}
+
+
+class TestSchemaCompiler(unittest.TestCase):
+    def assertCompiledMatchesAvro(self, schema, datum):
+        expected = io.BytesIO()
+        avro.io.DatumWriter(schema).write(datum, avro.io.BinaryEncoder(expected))
+
+        actual = io.BytesIO()
+        CompiledDatumWriter(schema).write(datum, avro.io.BinaryEncoder(actual))
+        self.assertEqual(actual.getvalue(), expected.getvalue())
+
+        actual.seek(0)
+        decoded = CompiledDatumReader(schema).read(avro.io.BinaryDecoder(actual))
+        expected.seek(0)
+        self.assertEqual(decoded, avro.io.DatumReader(schema).read(avro.io.BinaryDecoder(expected)))
+        self.assertEqual(actual.read(), b'')
+
+    def test_basic_and_advanced(self):
+        basic = confluent_avro.loads(data_gen.BASIC_SCHEMA)
+        for record in map(data_gen.create_basic_item, range(1, 20)):
+            self.assertCompiledMatchesAvro(basic, record)
+
+        adv = confluent_avro.loads(data_gen.ADVANCED_SCHEMA)
+        for record in map(data_gen.create_adv_item, range(1, 20)):
+            self.assertCompiledMatchesAvro(adv, record)
+
+    def test_all_types(self):
+        schema = confluent_avro.loads(ALL_TYPES_SCHEMA)
+        self.assertCompiledMatchesAvro(schema, ALL_TYPES_ITEM)
+        for u in (1 << 40, u'seven'):
+            item = dict(ALL_TYPES_ITEM, u=u)
+            self.assertCompiledMatchesAvro(schema, item)
+
+    def test_recursive(self):
+        schema = confluent_avro.loads(RECURSIVE_SCHEMA)
+        leaf = {'label': 'leaf', 'children': [], 'next': None}
+        node = {'label': 'root', 'children': [leaf, leaf], 'next': leaf}
+        self.assertCompiledMatchesAvro(schema, node)
+
+    def test_invalid_datum(self):
+        schema = confluent_avro.loads(ALL_TYPES_SCHEMA)
+        writer = CompiledDatumWriter(schema)
+        invalid = [dict(ALL_TYPES_ITEM, i=1 << 40),
+                   dict(ALL_TYPES_ITEM, e='CLUBS'),
+                   dict(ALL_TYPES_ITEM, fx=b'abc'),
+                   dict(ALL_TYPES_ITEM, u=1.5),
+                   dict(ALL_TYPES_ITEM, unknown=1),
+                   'not a record']
+        for datum in invalid:
+            with self.assertRaises(avro.io.AvroTypeException):
+                writer.write(datum, avro.io.BinaryEncoder(io.BytesIO()))
+
+    def test_lazy_record(self):
+        schema = confluent_avro.loads(ALL_TYPES_SCHEMA)
+        buf = io.BytesIO()
+        avro.io.DatumWriter(schema).write(ALL_TYPES_ITEM, avro.io.BinaryEncoder(buf))
+
+        reader = CompiledLazyDatumReader(schema)
+        for keys in (['u', 'b', 'm', 'a'], ['raw', 'raw', 'fx', 'i'], list(reversed(list(ALL_TYPES_ITEM)))):
+            buf.seek(0)
+            record = reader.read(avro.io.BinaryDecoder(buf))
+            for key in keys:
+                self.assertEqual(record[key], ALL_TYPES_ITEM[key])
+            self.assertEqual(record, ALL_TYPES_ITEM)
+
+        self.assertIn('u', record)
+        self.assertNotIn('missing', record)
+        with self.assertRaises(KeyError):
+            record['missing']
+
+    def test_lazy_recursive(self):
+        schema = confluent_avro.loads(RECURSIVE_SCHEMA)
+        leaf = {'label': 'leaf', 'children': [], 'next': None}
+        node = {'label': 'root', 'children': [leaf, leaf], 'next': leaf}
+        buf = io.BytesIO()
+        avro.io.DatumWriter(schema).write(node, avro.io.BinaryEncoder(buf))
+        buf.seek(0)
+        record = CompiledLazyDatumReader(schema).read(avro.io.BinaryDecoder(buf))
+        self.assertEqual(record['next'], leaf)
+        self.assertEqual(record['label'], 'root')
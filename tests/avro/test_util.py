@@ -40,3 +40,8 @@ class TestUtil(unittest.TestCase):
         with pytest.raises(avro.ClientError) as excinfo:
             avro.load(data_gen.get_schema_path("invalid_scema.avsc"))
         assert 'Schema parse failed:' in str(excinfo.value)
+
+    def test_schema_loads_invalid_json(self):
+        with pytest.raises(avro.ClientError) as excinfo:
+            avro.loads('{"type": "record",')
+        assert 'Schema parse failed:' in str(excinfo.value)
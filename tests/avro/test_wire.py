@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Confluent Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import io
+import unittest
+
+import avro.io
+
+from confluent_kafka.avro.serializer import wire
+
+LONGS = [0, 1, -1, 63, -64, 64, -65, 127, 128, 1 << 31, -(1 << 31), (1 << 63) - 1, -(1 << 63)]
+
+
+class TestWire(unittest.TestCase):
+    def assertEncodingMatchesAvro(self, method, values):
+        for value in values:
+            expected = io.BytesIO()
+            getattr(avro.io.BinaryEncoder(expected), 'write_' + method)(value)
+            actual = io.BytesIO()
+            getattr(wire.BinaryEncoder(actual), 'write_' + method)(value)
+            self.assertEqual(actual.getvalue(), expected.getvalue())
+
+            actual.seek(0)
+            self.assertEqual(getattr(wire.BinaryDecoder(actual), 'read_' + method)(), value)
+            self.assertEqual(actual.read(), b'')
+
+    def test_primitives(self):
+        self.assertEncodingMatchesAvro('long', LONGS + list(range(-65, 65)))
+        self.assertEncodingMatchesAvro('int', LONGS[:-2])
+        self.assertEncodingMatchesAvro('boolean', [True, False])
+        self.assertEncodingMatchesAvro('float', [0.0, 1.5, -2.25])
+        self.assertEncodingMatchesAvro('double', [0.0, 1.5, -1e300])
+        self.assertEncodingMatchesAvro('bytes', [b'', b'\x00\xff' * 100])
+        self.assertEncodingMatchesAvro('utf8', [u'', u'\xe9t\xe9', u'x' * 1000])
+
+    def test_writes_bytes(self):
+        """"Every chunk written should be bytes, the serializer joins them with b''.join"""
+
+        chunks = []
+        writer = type('Writer', (object,), {'write': staticmethod(chunks.append)})()
+        encoder = wire.BinaryEncoder(writer)
+        for value in LONGS:
+            encoder.write_long(value)
+        encoder.write_utf8(u'x' * 1000)
+        self.assertEqual([type(chunk) for chunk in chunks if type(chunk) is not bytes], [])
+
+    def test_truncated(self):
+        for method in ('long', 'int', 'boolean', 'float', 'double', 'bytes', 'utf8'):
+            with self.assertRaises(EOFError):
+                getattr(wire.BinaryDecoder(io.BytesIO(b'')), 'read_' + method)()
+        for data in (b'', b'\x80'):
+            with self.assertRaises(EOFError):
+                wire.BinaryDecoder(io.BytesIO(data)).read_long()
+            with self.assertRaises(EOFError):
+                wire.BinaryDecoder(io.BytesIO(data)).skip_long()
+        with self.assertRaises(EOFError):
+            wire.BinaryDecoder(io.BytesIO(b'\x04a')).read_bytes()
+
+    def test_header(self):
+        header = wire.pack_header(257)
+        self.assertEqual(header, b'\x00\x00\x00\x01\x01')
+        self.assertEqual(wire.read_header(header + b'\x02'), (wire.MAGIC_BYTE, 257, 5))